@@ -1,5 +1,13 @@
 #!/usr/bin/env python3
+import copy
+import functools
 import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent import futures
 
 import pika
 import logging
@@ -11,7 +19,10 @@ class ASynQ(object):
     """
 
     def __init__(self, url, routing_key, log_file='/dev/null', exchange='yacamc_exchange', exchange_type='direct',
-                 queue=None, acked=True, sender=False, otq = False, log_level=logging.FATAL):
+                 queue=None, acked=True, sender=False, otq = False, log_level=logging.FATAL, transport=None,
+                 prefetch_count=0, headers=None, ack_late=False, max_priority=None, lanes=None,
+                 coalesce=None, schemas=None, retries=0, retry_delay=1.0,
+                 channels=1, ordered=False, ttl=None, max_age=None):
         """
         this will set up an asynchronous queue on rabbitmq at url, with routing key routing_key, or give access if it
         already exists
@@ -23,6 +34,37 @@ class ASynQ(object):
         :param queue: the name of the queue. If not set explicitly, this will become the same as the routing_key
         :param acked: if this is true, message acknowledgements will be enabled
         :param sender: if true, this object will expect to send messages
+        :param transport: the connection class to use, pika.SelectConnection if not set. memory.Broker().connect gives
+        an in-process broker, so everything can run without rabbitmq
+        :param prefetch_count: the number of unacknowledged messages a consumer may hold. 0 means no limit
+        :param headers: a dict of headers to put on every message sent
+        :param ack_late: if this is true, messages are acknowledged after the callback returns instead of before it is
+        called. Messages whose callback fails are then redelivered (at least once delivery)
+        :param max_priority: if set, the queue is declared with x-max-priority, so messages sent with a priority (up to
+        this) overtake those with a lower one
+        :param lanes: if set, a consumer reads from one queue per lane instead of from queue. This is a list of
+        (name, weight) pairs: lane name is the queue queue.name, bound with routing_key.name, and the lanes are served
+        weighted fair by weight. Set prefetch_count too, so a busy lane cannot buffer an unbounded backlog
+        :param coalesce: if set, a consumer only handles the newest of the messages it has been delivered per key, and
+        acknowledges the rest unhandled. This is either the name of a header holding the key, or a function of
+        (properties, body) returning it. Messages without a key are all handled
+        :param schemas: if set, a dict of schema.Schema by routing key or content type. Bodies of messages with a
+        schema are decoded into its records before the callback is called. Bodies which do not decode are dead lettered
+        if retries is set, and dropped otherwise
+        :param retries: if set, a message whose callback raises is sent to a delay queue, and comes back to its queue
+        after retry_delay seconds, doubling with every attempt. After retries attempts it goes to the dead letter
+        exchange exchange.dlx, where queue.dead collects it
+        :param retry_delay: the number of seconds before the first retry
+        :param channels: the number of channels a sender publishes on. Every message goes to the channel with the
+        fewest unconfirmed messages, so with channels > 1 messages may overtake each other on their way to the queue,
+        unless they have the same ordering key (see stream)
+        :param ordered: if this is true, messages without an ordering key are ordered by their routing key. As a sender
+        publishes everything with its one routing key, that keeps it on one channel: for one key, ordering and
+        spreading over channels are mutually exclusive. Give the messages ordering keys to have both
+        :param ttl: if set, the number of seconds a message sent is of use. The broker drops it after that (expiration),
+        and so does a consumer receiving it late (x-deadline header)
+        :param max_age: if set, a consumer drops messages sent (x-timestamp header) more than max_age seconds ago,
+        without calling the callback
         """
 
         if queue is None:
@@ -33,29 +75,78 @@ class ASynQ(object):
         self.routing_key = routing_key
         self._url = url
         self.acked = acked
+        self.ack_late = ack_late
+        self.prefetch_count = prefetch_count
+        self.max_priority = max_priority
+        self.lanes = lanes
+        self.coalesce = coalesce
+        self.schemas = schemas
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retried = 0
+        self.dead = 0
+        self.channels = channels
+        self.ordered = ordered
+        self.ttl = ttl
+        self.max_age = max_age
+        self.expired = 0
+        self.priority = None
         self.otq = otq
+        self.transport = transport if transport is not None else pika.SelectConnection
 
         self.cb = None
+        self.profiler = None
+        self.recorder = None
+        self.dedup = None
 
         self._connection = None
         self._channel = None
         self._closing = False
 
+        # futures of work handed to other threads by the callback, see track
+        self._pending = set()
+        self._pending_done = threading.Event()
+
         log_format = '%(levelname) -10s %(asctime)s %(name) -30s %(funcName) -35s %(lineno) -5d: %(message)s'
-        handler = logging.FileHandler(log_file)
         logging.basicConfig(level=log_level, format=log_format)
         self.logger = logging.getLogger(__name__)
-        self.logger.addHandler(handler)
-
-        # used only for sending
-        self._deliveries = []
+        # the logger is shared by all instances, so only add a handler for log_file once (or we leak a file per object)
+        if not any(getattr(h, 'baseFilename', None) == os.path.abspath(log_file) for h in self.logger.handlers):
+            self.logger.addHandler(logging.FileHandler(log_file))
+
+        # used only for sending. Deliveries are the delivery tags yet to be confirmed, in a deque by channel number,
+        # and only kept with confirms on
+        self._deliveries = {}
+        self._outstanding = 0
+        self._publish_channels = []
+        self._published = {}
+        self._sticky = {}
+        self._sticky_keys = {}
+        self._ordering_key = None
         self._acked = 0
         self._nacked = 0
         self._message_number = 0
         self._stopping = False
         self._done_sending = False
         self.message = ""
+        self.headers = headers
         self.sender = sender
+        self._messages = None
+        self._interval = 0
+        self._next_send = 0
+
+        # used only for consuming lanes
+        self._lanes_pending = []
+        self._lane_buffers = []
+        self._lane_credit = []
+        self._lane_queues = {}
+        self._draining = False
+
+        # used only for coalescing
+        self._latest = OrderedDict()
+        self._last_tag = 0
+        self._flushing = False
+        self.coalesced = 0
 
         # self.run()
         # self._connection = self.connect()
@@ -73,17 +164,40 @@ class ASynQ(object):
         :return: None
         """
         confirmation_type = method_frame.method.NAME.split('.')[1].lower()
+        delivery_tag = method_frame.method.delivery_tag
+        number = method_frame.channel_number
+
+        self.logger.info('received %s for %s on channel %s', confirmation_type, delivery_tag, number)
+        tags = self._deliveries[number]
+        if method_frame.method.multiple:
+            # the server confirms everything on the channel up to and including delivery_tag in one go
+            confirmed = 0
+            while tags and tags[0] <= delivery_tag:
+                tags.popleft()
+                confirmed += 1
+        else:
+            # confirms come in the order of publishing, so this is nearly always the oldest
+            confirmed = 1
+            if tags[0] == delivery_tag:
+                tags.popleft()
+            else:
+                tags.remove(delivery_tag)
+        self._outstanding -= confirmed
+        if not tags:
+            # nothing is in flight on the channel, so the keys sticking to it are free to move
+            for key in self._sticky_keys.pop(number, ()):
+                if self._sticky.get(key) is not None and self._sticky[key].channel_number == number:
+                    del self._sticky[key]
 
-        self.logger.info('received %s for %s', confirmation_type, method_frame.method.delivery_tag)
         if confirmation_type == 'ack':
-            self._acked += 1
+            self._acked += confirmed
         elif confirmation_type == 'nack':
-            self._nacked += 1
+            self._nacked += confirmed
 
-        self._deliveries.remove(method_frame.method.delivery_tag)
         self.logger.info('published %i messages, %i yet to confirm, %i acked and %i nacked', self._message_number,
-                         len(self._deliveries), self._acked, self._nacked)
-        self.stop()
+                         self._outstanding, self._acked, self._nacked)
+        if self.sender and (self._messages is None or (self._done_sending and not self._outstanding)):
+            self.stop()
 
     def on_bindok(self, unused_frame):
         """
@@ -102,11 +216,66 @@ class ASynQ(object):
             self._channel.confirm_delivery(self.on_delivery_confirmation)
 
         if self.sender:
-            pass
-            self.send()
+            self._publish_channels = [self._channel]
+            if self.channels > 1:
+                self.open_publish_channels()
+            else:
+                self.start_sending()
         else:
+            if self.prefetch_count:
+                self._channel.basic_qos(prefetch_count=self.prefetch_count)
             self.start_consuming()
 
+    def open_publish_channels(self):
+        """
+        this opens the channels a sender publishes on besides the one it was set up on
+
+        :return: None
+        """
+        self.logger.info('opening %i more channels for publishing', self.channels - 1)
+        for _ in range(self.channels - 1):
+            self._connection.channel(on_open_callback=self.on_publish_channel_opened)
+
+    def on_publish_channel_opened(self, channel):
+        """
+        This is called when a channel for publishing is open. It is put in confirm mode like the first one, and once
+        they are all open, sending starts
+
+        :param channel: the channel that was opened
+        :return: None
+        """
+        channel.add_on_close_callback(self.on_publish_channel_closed)
+        if self.acked:
+            channel.confirm_delivery(self.on_delivery_confirmation)
+        self._publish_channels.append(channel)
+        if len(self._publish_channels) == self.channels:
+            self.start_sending()
+
+    def on_publish_channel_closed(self, channel, reply_code, reply_text):
+        """
+        as on_channel_closed, for the channels opened by open_publish_channels
+
+        :return: None
+        """
+        self.logger.warning('publishing channel closed: %s: %s', reply_code, reply_text)
+        if channel in self._publish_channels:
+            self._publish_channels.remove(channel)
+        if not self._stopping:
+            # this wasn't supposed to happen
+            self._connection.close()
+
+    def start_sending(self):
+        """
+        this sends the message put into self.message, or starts the stream set up by stream
+
+        :return: None
+        """
+        if self._messages is not None:
+            self._next_send = time.time()
+            self.send_next()
+        else:
+            self.send()
+
     def on_queue_declareok(self, method_frame):
         """
         This is called once the declaring of the queue is done. We call the binding function
@@ -123,11 +292,78 @@ class ASynQ(object):
 
         :return: None
         """
+        if self.retries and not self.sender:
+            self.setup_retries()
+
+        if self.lanes and not self.sender:
+            self.setup_lanes()
+            return
+
         self.logger.info('declaring queue %s', self.queue)
-        if self.otq:
-            self._channel.queue_declare(self.on_queue_declareok, self.queue, auto_delete=True)
+        self._channel.queue_declare(self.on_queue_declareok, self.queue, auto_delete=self.otq,
+                                    arguments=self.queue_arguments())
+
+    def queue_arguments(self):
+        """
+        :return: the arguments our queues are declared with
+        """
+        if self.max_priority:
+            return {'x-max-priority': self.max_priority}
+        return None
+
+    def setup_retries(self):
+        """
+        this declares the queues retried messages wait in, one per attempt for every queue we consume (every lane has
+        its own), and the dead letter exchange and queue. A retry queue holds its messages for its delay, and then
+        dead letters them back to the queue they came from. The channel handles the declarations in order, so they are
+        done before our own queues are
+
+        :return: None
+        """
+        if self.lanes:
+            queues = ['%s.%s' % (self.queue, name) for name, _ in self.lanes]
         else:
-            self._channel.queue_declare(self.on_queue_declareok, self.queue)
+            queues = [self.queue]
+        for queue in queues:
+            for attempt in range(self.retries):
+                arguments = {'x-message-ttl': int(self.retry_delay * 2 ** attempt * 1000),
+                             'x-dead-letter-exchange': '',
+                             'x-dead-letter-routing-key': queue}
+                self.logger.info('declaring retry queue %s.retry.%i', queue, attempt)
+                self._channel.queue_declare(None, '%s.retry.%i' % (queue, attempt), arguments=arguments)
+
+        self.logger.info('declaring dead letter exchange %s.dlx', self.exchange)
+        self._channel.exchange_declare(None, '%s.dlx' % self.exchange, 'direct')
+        self._channel.queue_declare(None, '%s.dead' % self.queue)
+        self._channel.queue_bind(None, '%s.dead' % self.queue, '%s.dlx' % self.exchange, self.routing_key)
+
+    # The following functions set up the queues of the lanes, one after the other, and then continue as on_bindok
+
+    def setup_lanes(self):
+        """
+        this starts the declaration of the lane queues
+
+        :return: None
+        """
+        self._lanes_pending = [name for name, _ in self.lanes]
+        self.declare_lane()
+
+    def declare_lane(self):
+        queue = '%s.%s' % (self.queue, self._lanes_pending[0])
+        self.logger.info('declaring lane queue %s', queue)
+        self._channel.queue_declare(self.on_lane_declareok, queue, arguments=self.queue_arguments())
+
+    def on_lane_declareok(self, method_frame):
+        name = self._lanes_pending[0]
+        self._channel.queue_bind(self.on_lane_bindok, '%s.%s' % (self.queue, name), self.exchange,
+                                 '%s.%s' % (self.routing_key, name))
+
+    def on_lane_bindok(self, frame):
+        self._lanes_pending.pop(0)
+        if self._lanes_pending:
+            self.declare_lane()
+        else:
+            self.on_bindok(frame)
 
     # The following sets up the exchange, which is the part of the queueing system that determines how messages are
     # sent from producers to consumers
@@ -204,7 +440,12 @@ class ASynQ(object):
         :return: None
         """
         # only used for sending:
-        self._deliveries = []
+        self._deliveries = {}
+        self._outstanding = 0
+        self._publish_channels = []
+        self._published = {}
+        self._sticky = {}
+        self._sticky_keys = {}
         self._acked = 0
         self._nacked = 0
         self._message_number = 0
@@ -252,7 +493,7 @@ class ASynQ(object):
         :return: the connection
         """
         self.logger.info('connecting to %s', self._url)
-        return pika.SelectConnection(pika.URLParameters(self._url), self.on_connection_open, stop_ioloop_on_close=False)
+        return self.transport(pika.URLParameters(self._url), self.on_connection_open, stop_ioloop_on_close=False)
 
     def send(self):
         """
@@ -263,6 +504,7 @@ class ASynQ(object):
         if self._stopping:
             return
 
+        ordering_key = self._ordering_key(self.message) if self._ordering_key is not None else None
         mytype = 'text/plain'
 
         try:
@@ -275,13 +517,97 @@ class ASynQ(object):
             else:
                 self.message = str(self.message)
 
+        # times go in milliseconds, as amqp headers cannot hold floats
+        now = time.time()
+        headers = dict(self.headers or {})
+        headers['x-timestamp'] = int(now * 1000)
+        expiration = None
+        if self.ttl is not None:
+            headers['x-deadline'] = int((now + self.ttl) * 1000)
+            expiration = str(int(self.ttl * 1000))
+
         properties = pika.BasicProperties(app_id='sender',
-                                          content_type=mytype)
+                                          content_type=mytype,
+                                          message_id=uuid.uuid4().hex,
+                                          priority=self.priority,
+                                          timestamp=int(now),
+                                          expiration=expiration,
+                                          headers=headers)
 
-        self._channel.basic_publish(self.exchange, self.routing_key, self.message, properties)
+        self.publish(self.message, properties, ordering_key=ordering_key)
+
+    def publish(self, body, properties, exchange=None, routing_key=None, ordering_key=None):
+        """
+        this puts body on the queue, and (with confirms on) keeps track of it until the server confirms it
+
+        :param body: the body of the message
+        :param properties: the pika.BasicProperties of the message
+        :param exchange: the exchange to publish to, if not ours
+        :param routing_key: the routing key to publish with, if not ours
+        :param ordering_key: if set, the message is published in order with the others of this key. Otherwise it is
+        ordered by routing key if ordered is set, and not at all if not
+        :return: None
+        """
+        if routing_key is None:
+            routing_key = self.routing_key
+        if ordering_key is None and self.ordered:
+            ordering_key = routing_key
+        channel = self.pick_channel(ordering_key)
+        channel.basic_publish(self.exchange if exchange is None else exchange, routing_key, body, properties)
+
+        number = channel.channel_number
+        self._published[number] = self._published.get(number, 0) + 1
         self._message_number += 1
-        self._deliveries.append(self._message_number)
-        self.logger.info('published message # %i', self._message_number)
+        if self.acked:
+            # delivery tags count the messages published on the channel
+            self._deliveries.setdefault(number, deque()).append(self._published[number])
+            self._outstanding += 1
+        if ordering_key is not None and self.acked and len(self._publish_channels) > 1:
+            self._sticky[ordering_key] = channel
+            self._sticky_keys.setdefault(number, set()).add(ordering_key)
+        self.logger.info('published message # %i on channel %i', self._message_number, number)
+
+    def pick_channel(self, ordering_key=None):
+        """
+        :param ordering_key: the ordering key of the message about to be published, if it has one
+        :return: the channel to publish it on: the channel the ordering key sticks to while that has unconfirmed
+        messages (without confirms, a channel picked by hash of the key, as we never learn when it would be safe to
+        move), and otherwise the one with the fewest unconfirmed messages, and of those the one which has published the
+        least
+        """
+        if len(self._publish_channels) < 2:
+            return self._channel
+        if ordering_key is not None:
+            if not self.acked:
+                return self._publish_channels[hash(ordering_key) % len(self._publish_channels)]
+            channel = self._sticky.get(ordering_key)
+            if channel is not None and channel in self._publish_channels:
+                return channel
+        return min(self._publish_channels, key=lambda c: (len(self._deliveries.get(c.channel_number, ())),
+                                                          self._published.get(c.channel_number, 0)))
+
+    def send_next(self):
+        """
+        this sends the next message of the stream set up by stream, and schedules the one after it. Messages are
+        scheduled from the start of the stream, so slow sends do not make the stream drift. Once the stream is
+        exhausted we stop, when every message has been confirmed
+
+        :return: None
+        """
+        if self._stopping:
+            return
+
+        try:
+            self.message = next(self._messages)
+        except StopIteration:
+            self._done_sending = True
+            if not self.acked or not self._outstanding:
+                self.stop()
+            return
+
+        self.send()
+        self._next_send += self._interval
+        self._connection.add_timeout(max(0, self._next_send - time.time()), self.send_next)
 
     def stop(self):
         """
@@ -291,6 +617,10 @@ class ASynQ(object):
         """
         self.logger.info('stopping')
         self._stopping = True
+        if self.profiler is not None:
+            self.profiler.dump()
+        if self.recorder is not None:
+            self.recorder.close()
         if self._channel:
             self._channel.close()
         self._closing = True
@@ -312,8 +642,102 @@ class ASynQ(object):
 
         self.logger.info('consuming started, adding cancel callback')
         self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
+        if self.lanes:
+            self._lane_buffers = [deque() for _ in self.lanes]
+            self._lane_credit = [0] * len(self.lanes)
+            for lane, (name, _) in enumerate(self.lanes):
+                queue = '%s.%s' % (self.queue, name)
+                tag = self._channel.basic_consume(functools.partial(self.on_lane_message, lane), queue)
+                # so a failed message can be retried on the lane it came from
+                self._lane_queues[tag] = queue
+            return
+        if self.coalesce is not None:
+            self._consumer_tag = self._channel.basic_consume(self.on_coalesce_message, self.queue)
+            return
         self._consumer_tag = self._channel.basic_consume(self.on_message, self.queue)
 
+    def on_coalesce_message(self, channel, method, properties, body):
+        """
+        the message called when a message is received in coalescing mode. It replaces any older message with the same
+        key, and schedules flush_coalesced to run once the deliveries at hand have been read
+
+        :param channel: the channel of the object
+        :param method: the method of the message
+        :param properties: the properties of this message
+        :param body: the message itself
+        :return: None
+        """
+        if self.recorder is not None:
+            self.recorder.record(method.routing_key, properties, body)
+        if callable(self.coalesce):
+            key = self.coalesce(properties, body)
+        else:
+            key = (properties.headers or {}).get(self.coalesce)
+        if key is None:
+            # no key, nothing to coalesce with
+            key = ('delivery', method.delivery_tag)
+        elif key in self._latest:
+            self.coalesced += 1
+            self._latest.move_to_end(key)
+        self._latest[key] = (channel, method, properties, body)
+        self._last_tag = method.delivery_tag
+        if not self._flushing:
+            self._flushing = True
+            self._connection.add_timeout(0, self.flush_coalesced)
+
+    def flush_coalesced(self):
+        """
+        this handles the newest message of every key, and then acknowledges everything delivered so far in one go,
+        superseded messages included
+
+        :return: None
+        """
+        self._flushing = False
+        latest, self._latest = self._latest, OrderedDict()
+        last_tag = self._last_tag
+        for message in latest.values():
+            self.process_message(*message)
+            if self._stopping:
+                return
+        if self.acked and self._channel:
+            self.logger.info('acknowledging messages up to %s', last_tag)
+            self._channel.basic_ack(last_tag, multiple=True)
+
+    def on_lane_message(self, lane, channel, method, properties, body):
+        """
+        the message called when a message is received on a lane. It is buffered, and handled by drain_lanes
+
+        :param lane: the index of the lane in self.lanes
+        :return: None
+        """
+        if self.recorder is not None:
+            self.recorder.record(method.routing_key, properties, body)
+        self._lane_buffers[lane].append((channel, method, properties, body))
+        if not self._draining:
+            self._draining = True
+            self._connection.add_timeout(0, self.drain_lanes)
+
+    def drain_lanes(self):
+        """
+        this handles one buffered message, picked from the lanes by smooth weighted round robin, and reschedules itself
+        while messages are buffered. Handling one message per turn of the ioloop lets new deliveries on an urgent lane
+        in before the next pick
+
+        :return: None
+        """
+        active = [lane for lane, buffer in enumerate(self._lane_buffers) if buffer]
+        if not active or self._stopping:
+            self._draining = False
+            return
+
+        for lane in active:
+            self._lane_credit[lane] += self.lanes[lane][1]
+        picked = max(active, key=lambda lane: self._lane_credit[lane])
+        self._lane_credit[picked] -= sum(self.lanes[lane][1] for lane in active)
+
+        self.process_message(*self._lane_buffers[picked].popleft())
+        self._connection.add_timeout(0, self.drain_lanes)
+
     def on_consumer_cancelled(self, method_frame):
         """
         this is the function called, if the consumer thread decides to stop consuming. It starts the cascade that
@@ -328,8 +752,8 @@ class ASynQ(object):
 
     def on_message(self, channel, method, properties, body):
         """
-        the message called when a message is received. It possibly acknowledges the message, and then calls the
-        callback routine defined by the user
+        the message called when a message is received. If a recorder is set, the message is handed to it as it arrives
+        (as are the messages buffered by on_coalesce_message and on_lane_message), and then it is processed
 
         :param channel: the channel of the object
         :param method: the method of the message
@@ -337,16 +761,218 @@ class ASynQ(object):
         :param body: the message itself
         :return:
         """
-        if self.acked:
+        if self.recorder is not None:
+            self.recorder.record(method.routing_key, properties, body)
+        self.process_message(channel, method, properties, body)
+
+    def process_message(self, channel, method, properties, body):
+        """
+        this processes a message. If a profiler is set, it is told when we enter and leave, so it can sample this
+        invocation. The actual work is done in handle_message
+
+        :param channel: the channel of the object
+        :param method: the method of the message
+        :param properties: the properties of this message
+        :param body: the message itself
+        :return:
+        """
+        if self.profiler is None:
+            self.handle_message(channel, method, properties, body)
+            return
+
+        self.profiler.enter()
+        try:
+            self.handle_message(channel, method, properties, body,
+                                timer=self.profiler if self.profiler.active else None)
+        finally:
+            self.profiler.leave()
+
+    def handle_message(self, channel, method, properties, body, timer=None):
+        """
+        this possibly acknowledges the message, and then calls the callback routine defined by the user. Stale
+        messages (see is_stale) are dropped before anything else is done with them. If a dedup cache is set, messages
+        it has seen already are acknowledged and skipped, and the ids of messages the callback handled are added to it
+
+        :param channel: the channel of the object
+        :param method: the method of the message
+        :param properties: the properties of this message
+        :param body: the message itself
+        :param timer: if set, the end of every phase is marked on it (see profiling.Profiler)
+        :return:
+        """
+        # when coalescing, messages are acknowledged in bulk by flush_coalesced
+        ack = self.acked and self.coalesce is None
+        if ack and not self.ack_late:
             self.acknowledge_message(method.delivery_tag)
+        if timer is not None:
+            timer.mark('ack')
+
+        if self.is_stale(properties):
+            self.expired += 1
+            self.logger.info('dropping stale message %s', method.delivery_tag)
+            self.finish_message(method)
+            return
+
+        message_id = properties.message_id
+        if self.dedup is not None and message_id is not None and message_id in self.dedup:
+            self.logger.info('skipping duplicate message %s', message_id)
+            self.finish_message(method)
+            return
+
         if self.cb is not None:
+            raw = body
+            if self.schemas is not None:
+                schema = self.schemas.get(method.routing_key) or self.schemas.get(properties.content_type)
+                if schema is not None:
+                    try:
+                        body = schema.decode(body)
+                    except ValueError as error:
+                        # there is no point in retrying a message that doesn't decode, but it is kept if we can
+                        self.logger.error('message %s does not decode: %s', method.delivery_tag, error)
+                        if self.retries:
+                            self.dead_letter(properties, raw)
+                        self.finish_message(method)
+                        return
+            if timer is not None:
+                timer.mark('decode')
             # call the user specified callback
-            self.cb(channel, method, properties, body)
-            if self.otq:
-                self.stop()
+            try:
+                result = self.cb(channel, method, properties, body)
+            except Exception:
+                if not self.retries:
+                    raise
+                self.logger.exception('callback failed for message %s', method.delivery_tag)
+                self.retry(properties, raw, self._lane_queues.get(method.consumer_tag, self.queue))
+            else:
+                if isinstance(result, futures.Future):
+                    # the callback goes on in another thread, and the message is done when that is
+                    self.track(result, functools.partial(self.on_callback_done, method, properties, raw))
+                    if timer is not None:
+                        timer.mark('callback')
+                    return
+                # the retried copy keeps its id, so only messages which were handled count as seen
+                if self.dedup is not None and message_id is not None:
+                    self.dedup.add(message_id)
+            if timer is not None:
+                timer.mark('callback')
+            self.finish_message(method, timer)
         else:
             self.logger.error("Received message, but no callback routine set")
 
+    def on_callback_done(self, method, properties, body, future):
+        """
+        this is called on the ioloop when the work a callback handed to another thread (see track) is done. The message
+        is then failed, or done with, as if the callback had just raised or returned
+
+        :param method: the method of the message
+        :param properties: the properties of the message
+        :param body: the message itself, as received
+        :param future: the future of the work
+        :return: None
+        """
+        error = future.exception()
+        if error is not None:
+            if not self.retries:
+                raise error
+            self.logger.error('callback failed for message %s: %r', method.delivery_tag, error)
+            self.retry(properties, body, self._lane_queues.get(method.consumer_tag, self.queue))
+        elif self.dedup is not None and properties.message_id is not None:
+            self.dedup.add(properties.message_id)
+        self.finish_message(method)
+
+    def finish_message(self, method, timer=None):
+        """
+        this is done last with every message, also those which are dropped or skipped: it is acknowledged if that was
+        left until after the callback, and a one time queue consumer stops
+
+        :param method: the method of the message
+        :param timer: if set, the acknowledgement is marked on it
+        :return: None
+        """
+        if self.acked and self.coalesce is None and self.ack_late:
+            self.acknowledge_message(method.delivery_tag)
+            if timer is not None:
+                timer.mark('ack')
+        if self.otq:
+            self.stop()
+
+    def is_stale(self, properties):
+        """
+        checks whether a message is past its x-deadline header, or older than max_age
+
+        :param properties: the properties of the message
+        :return: True if nobody is waiting for the message any more
+        """
+        headers = properties.headers
+        deadline = headers.get('x-deadline') if headers else None
+        if deadline is None and self.max_age is None:
+            return False
+
+        now = time.time() * 1000
+        if deadline is not None and now > deadline:
+            return True
+        if self.max_age is not None:
+            sent = headers.get('x-timestamp') if headers else None
+            if sent is None and properties.timestamp is not None:
+                sent = properties.timestamp * 1000
+            return sent is not None and now - sent > self.max_age * 1000
+        return False
+
+    def retry(self, properties, body, queue=None):
+        """
+        sends a message whose callback failed to the retry queue of its next attempt, or to the dead letter exchange
+        if it has had all its attempts. The number of attempts so far is kept in the x-retry-count header
+
+        :param properties: the properties of the message
+        :param body: the message itself, as received
+        :param queue: the queue the message came from, if not ours (a lane)
+        :return: None
+        """
+        attempt = (properties.headers or {}).get('x-retry-count', 0)
+        properties = copy.copy(properties)
+        properties.headers = dict(properties.headers or {}, **{'x-retry-count': attempt + 1})
+        if attempt < self.retries:
+            self.retried += 1
+            self.publish(body, properties, '', '%s.retry.%i' % (queue or self.queue, attempt))
+        else:
+            self.logger.warning('message %s failed %i times', properties.message_id, attempt + 1)
+            self.dead_letter(properties, body)
+
+    def dead_letter(self, properties, body):
+        """
+        sends a message to the dead letter exchange, where queue.dead collects it. It is only declared with retries set
+
+        :param properties: the properties of the message
+        :param body: the message itself, as received
+        :return: None
+        """
+        self.dead += 1
+        self.logger.warning('dead lettering message %s', properties.message_id)
+        self.publish(body, properties, '%s.dlx' % self.exchange)
+
+    def track(self, future, done=None):
+        """
+        keeps serving until future, the work a callback has handed to another thread, is done. A callback doing so
+        returns the future, and hands its results back with add_callback_threadsafe from a done callback (see
+        rpccache.ResponseCache). Those run before ours, so everything they add to the ioloop is there when we let go
+
+        :param future: a concurrent.futures.Future
+        :param done: if set, this is called with the future on the ioloop when it is done
+        :return: None
+        """
+        self._pending.add(future)
+        future.add_done_callback(functools.partial(self.on_pending_done, done))
+
+    def on_pending_done(self, done, future):
+        # this runs in the thread of the future
+        self._connection.add_callback_threadsafe(functools.partial(self.settle, done, future))
+        self._pending_done.set()
+
+    def settle(self, done, future):
+        self._pending.discard(future)
+        if done is not None:
+            done(future)
+
     def acknowledge_message(self, delivery_tag):
         """
         this acks a message received by a consumer thread
@@ -365,25 +991,60 @@ class ASynQ(object):
         """
         self._connection = self.connect()
         self._connection.ioloop.start()
-
-    def serve(self,cb):
+        # an ioloop returning when out of work (see memory.Broker) may do so while callbacks still have work in other
+        # threads. Wait for that, and run the loop again for what it hands back
+        while self._pending and not self._stopping:
+            self._pending_done.wait()
+            self._pending_done.clear()
+            self._connection.ioloop.start()
+
+    def serve(self,cb, profiler=None, recorder=None, dedup=None):
         """
         starts a consumer with callback cb
 
-        :param cb: the callback routine
+        :param cb: the callback routine. If it hands the work on to another thread, it may return the
+        concurrent.futures.Future of it, and we keep serving until it is done (see track)
+        :param profiler: if set, a profiling.Profiler which samples the handling of incoming messages
+        :param recorder: if set, a recording.Recorder which writes (a sample of) incoming messages to a log
+        :param dedup: if set, a dedup.DedupCache used to skip messages which have been processed already
         :return: None
         """
         self.cb = cb
+        self.profiler = profiler
+        self.recorder = recorder
+        self.dedup = dedup
+        if profiler is not None:
+            profiler.install()
+        self.run()
+
+    def stream(self, messages, interval=0, priority=None, ordering_key=None):
+        """
+        send every message in messages to the defined queue over a single connection, one every interval seconds
+
+        :param messages: an iterable of messages, each as they would be given to client
+        :param interval: the number of seconds between messages. 0 sends as fast as possible
+        :param priority: the priority of the messages, for queues declared with max_priority
+        :param ordering_key: if set, a function of a message returning its ordering key. With channels > 1, messages
+        with the same ordering key stay in order, on one channel while any of them is unconfirmed, and messages with
+        different keys are spread over the channels
+        :return:
+        """
+        self._messages = iter(messages)
+        self._ordering_key = ordering_key
+        self.priority = priority
+        self._interval = interval
         self.run()
 
-    def client(self,message):
+    def client(self,message, priority=None):
         """
         send the message to the defined queue
 
         :param message: the message to be sent
+        :param priority: the priority of the message, for queues declared with max_priority
         :return:
         """
         self.message = message
+        self.priority = priority
         self.run()
 
 # class Receiver:
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Deduplication of redelivered messages for idempotent consumers. ASynQ stamps a message_id on everything it sends, and a
+consumer handed a DedupCache skips ids it has already processed, before the callback runs.
+
+A DedupCache lives in the memory of one process. Sibling worker processes can share what they have processed through
+a SharedIndex, a fixed size hash table in a file mapped by all of them.
+"""
+import collections
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+
+SLOT = struct.Struct('<16sd')
+
+
+class SharedIndex(object):
+    """
+    this class implements a set of message ids with expiry times, as an open addressing hash table in a memory mapped
+    file. Every process opening the same path shares the table. Writers take a file lock; readers do not, so a lookup
+    racing an insert of the same id may miss it (which only means the message is processed twice, as without dedup)
+    """
+
+    def __init__(self, path, slots=1 << 20, probes=16):
+        """
+        opens (or creates) the index at path
+
+        :param path: the index file
+        :param slots: the number of ids the table can hold. Every process sharing the file must use the same number
+        :param probes: the number of slots searched for an id before giving up (and evicting the oldest of them)
+        """
+        self.path = path
+        self.slots = slots
+        self.probes = probes
+
+        self._file = open(path, 'a+b')
+        size = slots * SLOT.size
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    @staticmethod
+    def digest(message_id):
+        return hashlib.blake2b(message_id.encode('utf-8'), digest_size=16).digest()
+
+    def _offsets(self, digest):
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        return [((start + i) % self.slots) * SLOT.size for i in range(self.probes)]
+
+    def __contains__(self, message_id):
+        digest = self.digest(message_id)
+        now = time.time()
+        for offset in self._offsets(digest):
+            key, expires = SLOT.unpack_from(self._map, offset)
+            if key == digest:
+                return expires > now
+            if expires == 0:
+                # an empty slot ends the probe
+                return False
+        return False
+
+    def add(self, message_id, expires):
+        """
+        adds message_id to the index until the time expires
+
+        :param message_id: the id of the message
+        :param expires: the time (since the epoch) after which the id is forgotten
+        :return: None
+        """
+        digest = self.digest(message_id)
+        now = time.time()
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            oldest = None
+            for offset in self._offsets(digest):
+                key, slot_expires = SLOT.unpack_from(self._map, offset)
+                if key == digest or slot_expires < now:
+                    break
+                if oldest is None or slot_expires < oldest[1]:
+                    oldest = (offset, slot_expires)
+            else:
+                offset = oldest[0]
+            SLOT.pack_into(self._map, offset, digest, expires)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class DedupCache(object):
+    """
+    this class remembers the ids of processed messages, for at most maxsize ids (least recently seen are forgotten
+    first) and at most ttl seconds each. If shared is set, ids are also written to, and looked up in, a SharedIndex
+    """
+
+    def __init__(self, maxsize=100000, ttl=3600, shared=None):
+        """
+        :param maxsize: the number of ids kept in memory
+        :param ttl: the number of seconds an id is remembered
+        :param shared: an optional SharedIndex, shared with sibling processes
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.hits = 0
+        self._seen = collections.OrderedDict()
+
+    def __contains__(self, message_id):
+        expires = self._seen.get(message_id)
+        if expires is not None:
+            if expires > time.time():
+                self._seen.move_to_end(message_id)
+                self.hits += 1
+                return True
+            del self._seen[message_id]
+        if self.shared is not None and message_id in self.shared:
+            self.hits += 1
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, message_id):
+        """
+        remembers that message_id has been processed
+
+        :param message_id: the id of the message
+        :return: None
+        """
+        expires = time.time() + self.ttl
+        self._seen[message_id] = expires
+        self._seen.move_to_end(message_id)
+        while len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+        if self.shared is not None:
+            self.shared.add(message_id, expires)
@@ -0,0 +1,678 @@
+#!/usr/bin/env python3
+"""
+An in-process stand in for rabbitmq. A Broker hands out connections which mimic pika.SelectConnection closely enough
+for ASynQ to run its whole state machine against it, without any network. Pass Broker.connect as the transport of an
+ASynQ:
+
+    broker = memory.Broker()
+    rec = asynq.ASynQ(url='amqp://localhost/', routing_key='asynq_test', transport=broker.connect)
+
+The url is still parsed by pika, but otherwise ignored.
+
+Every connection has its own ioloop, as with pika. Unlike pika, an ioloop returns from start when it runs out of work,
+so a consumer returns from serve once its queue is drained (and can be resumed with start_loop). tests/ runs ASynQ
+against it.
+"""
+import collections
+import copy
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import pika
+from pika import exceptions
+from pika import frame
+from pika import spec
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=4096)
+def topic_match(pattern, routing_key):
+    """
+    matches a routing key against a topic binding pattern, where * matches exactly one word and # zero or more words
+
+    :param pattern: the binding pattern
+    :param routing_key: the routing key of a message
+    :return: True if the routing key matches
+    """
+    def match(p, k):
+        if not p:
+            return not k
+        if p[0] == '#':
+            return any(match(p[1:], k[i:]) for i in range(len(k) + 1))
+        if not k:
+            return False
+        return (p[0] == '*' or p[0] == k[0]) and match(p[1:], k[1:])
+
+    return match(tuple(pattern.split('.')), tuple(routing_key.split('.')))
+
+
+class ChannelError(Exception):
+    """
+    raised inside the broker when a channel operation violates the protocol. The channel is closed with reply_code
+    """
+
+    def __init__(self, reply_code, reply_text):
+        super(ChannelError, self).__init__(reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = reply_text
+
+
+class Message(object):
+    """
+    a message, as it sits on a queue
+    """
+    __slots__ = ('exchange', 'routing_key', 'body', 'properties', 'redelivered', 'expires')
+
+    def __init__(self, exchange, routing_key, body, properties, expires=None):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.redelivered = False
+        self.expires = expires
+
+
+class Exchange(object):
+    """
+    an exchange and its bindings
+    """
+
+    def __init__(self, name, exchange_type):
+        self.name = name
+        self.exchange_type = exchange_type
+        self.bindings = []
+
+    def route(self, routing_key):
+        """
+        finds the queues a message with routing_key should be put on
+
+        :param routing_key: the routing key of the message
+        :return: a list of queue names
+        """
+        if self.exchange_type == 'fanout':
+            matches = [queue for queue, _ in self.bindings]
+        elif self.exchange_type == 'topic':
+            matches = [queue for queue, key in self.bindings if topic_match(key, routing_key)]
+        else:
+            matches = [queue for queue, key in self.bindings if key == routing_key]
+        # a queue bound twice only gets the message once
+        return list(collections.OrderedDict.fromkeys(matches))
+
+
+class Queue(object):
+    """
+    a queue, and the consumers attached to it. A queue declared with x-max-priority keeps a deque of messages per
+    priority, and hands out the highest priority first. Messages expire after the x-message-ttl of the queue, or the
+    expiration property of the message, and are then dead lettered if the queue has an x-dead-letter-exchange
+    """
+
+    def __init__(self, name, auto_delete=False, arguments=None):
+        self.name = name
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.max_priority = self.arguments.get('x-max-priority', 0)
+        self.ttl = self.arguments.get('x-message-ttl')
+        self.levels = [collections.deque() for _ in range(self.max_priority + 1)]
+        self.consumers = collections.deque()
+
+    def __len__(self):
+        return sum(len(level) for level in self.levels)
+
+    def _level(self, message):
+        if not self.max_priority:
+            return self.levels[0]
+        return self.levels[min(message.properties.priority or 0, self.max_priority)]
+
+    def push(self, message):
+        self._level(message).append(message)
+
+    def push_front(self, message):
+        self._level(message).appendleft(message)
+
+    def pop(self):
+        for level in reversed(self.levels):
+            if level:
+                return level.popleft()
+        raise IndexError('pop from an empty queue')
+
+    def expires(self, properties, now):
+        """
+        :return: the time a message with properties expires when put on the queue now, or None if it doesn't
+        """
+        ttls = [ttl for ttl in (self.ttl, properties.expiration) if ttl is not None]
+        if not ttls:
+            return None
+        return now + min(int(ttl) for ttl in ttls) / 1000.0
+
+    def expire(self, now):
+        """
+        removes the expired messages. As with rabbitmq, only messages at the head of the queue are expired
+
+        :param now: the current time
+        :return: the expired messages
+        """
+        expired = []
+        for level in self.levels:
+            while level and level[0].expires is not None and level[0].expires <= now:
+                expired.append(level.popleft())
+        return expired
+
+
+class Broker(object):
+    """
+    this class implements the broker itself. It holds the exchanges and queues shared by all its connections
+    """
+
+    def __init__(self):
+        self.exchanges = {}
+        self.queues = {}
+        self._names = itertools.count(1)
+
+    def connect(self, parameters=None, on_open_callback=None, on_open_error_callback=None, on_close_callback=None,
+                stop_ioloop_on_close=True):
+        """
+        opens a connection to the broker. The signature is that of pika.SelectConnection, so this can be used as the
+        transport of an ASynQ
+
+        :param parameters: not used
+        :param on_open_callback: called with the connection once it is open
+        :param on_open_error_callback: not used, connecting cannot fail
+        :param on_close_callback: called when the connection is closed
+        :param stop_ioloop_on_close: if true, the ioloop is stopped when the connection is closed
+        :return: the connection
+        """
+        return Connection(self, on_open_callback, on_close_callback, stop_ioloop_on_close)
+
+    def queue_length(self, queue):
+        """
+        :param queue: the name of a queue
+        :return: the number of messages waiting on the queue (0 if it doesn't exist)
+        """
+        if queue not in self.queues:
+            return 0
+        return len(self.queues[queue])
+
+    def declare_exchange(self, name, exchange_type, passive):
+        exchange = self.exchanges.get(name)
+        if exchange is None:
+            if passive:
+                raise ChannelError(404, "NOT_FOUND - no exchange '%s'" % name)
+            exchange = self.exchanges[name] = Exchange(name, exchange_type)
+        elif exchange.exchange_type != exchange_type and not passive:
+            raise ChannelError(406, "PRECONDITION_FAILED - inequivalent arg 'type' for exchange '%s'" % name)
+        return exchange
+
+    def declare_queue(self, name, passive, auto_delete, arguments):
+        if not name:
+            name = 'amq.gen-%i' % next(self._names)
+        queue = self.queues.get(name)
+        if queue is None:
+            if passive:
+                raise ChannelError(404, "NOT_FOUND - no queue '%s'" % name)
+            queue = self.queues[name] = Queue(name, auto_delete, arguments)
+        elif not passive and queue.arguments != (arguments or {}):
+            raise ChannelError(406, "PRECONDITION_FAILED - inequivalent arguments for queue '%s'" % name)
+        return queue
+
+    def bind(self, queue, exchange, routing_key):
+        if queue not in self.queues:
+            raise ChannelError(404, "NOT_FOUND - no queue '%s'" % queue)
+        if exchange not in self.exchanges:
+            raise ChannelError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+        binding = (queue, routing_key)
+        if binding not in self.exchanges[exchange].bindings:
+            self.exchanges[exchange].bindings.append(binding)
+        return binding
+
+    def publish(self, exchange, routing_key, body, properties, ioloop=None):
+        """
+        routes a message to its queues, and hands it to consumers if any are ready
+
+        :param ioloop: the ioloop of the publishing connection, which runs the expiry of messages with a ttl
+        :return: True if the message was routed to at least one queue
+        """
+        if exchange == '':
+            names = [routing_key] if routing_key in self.queues else []
+        elif exchange in self.exchanges:
+            names = self.exchanges[exchange].route(routing_key)
+        else:
+            raise ChannelError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+        now = time.time()
+        for name in names:
+            queue = self.queues[name]
+            expires = queue.expires(properties, now)
+            queue.push(Message(exchange, routing_key, body, properties, expires))
+            if expires is not None and ioloop is not None:
+                ioloop.add_timeout(expires - now, functools.partial(self.expire, name, ioloop))
+            self.dispatch(queue)
+        return bool(names)
+
+    def expire(self, name, ioloop=None):
+        """
+        drops the expired messages of a queue, dead lettering them if the queue says so
+
+        :param name: the name of the queue
+        :param ioloop: the ioloop running the expiry of the dead lettered messages
+        :return: None
+        """
+        queue = self.queues.get(name)
+        if queue is None:
+            return
+        exchange = queue.arguments.get('x-dead-letter-exchange')
+        for message in queue.expire(time.time()):
+            if exchange is not None:
+                routing_key = queue.arguments.get('x-dead-letter-routing-key', message.routing_key)
+                # a dead lettered message does not carry its expiration along, as with rabbitmq
+                properties = copy.copy(message.properties)
+                properties.expiration = None
+                self.publish(exchange, routing_key, message.body, properties, ioloop)
+
+    def dispatch(self, queue):
+        """
+        hands messages of queue to its consumers round robin, as long as they have room in their prefetch window
+
+        :param queue: the queue
+        :return: None
+        """
+        self.expire(queue.name)
+        while queue.consumers and len(queue):
+            for _ in range(len(queue.consumers)):
+                consumer = queue.consumers[0]
+                queue.consumers.rotate(-1)
+                if consumer.ready():
+                    consumer.deliver(queue.pop())
+                    break
+            else:
+                # every consumer has a full prefetch window
+                return
+
+    def requeue(self, queue, messages):
+        """
+        puts messages back at the head of queue (in their original order), marked as redelivered
+
+        :param queue: the name of the queue
+        :param messages: the messages
+        :return: None
+        """
+        if queue not in self.queues:
+            return
+        for message in reversed(messages):
+            message.redelivered = True
+            self.queues[queue].push_front(message)
+        self.dispatch(self.queues[queue])
+
+    def remove_consumer(self, consumer):
+        queue = self.queues.get(consumer.queue)
+        if queue is None or consumer not in queue.consumers:
+            return
+        queue.consumers.remove(consumer)
+        # as with rabbitmq, an auto delete queue goes when its last consumer does, so one which never had a consumer
+        # stays around
+        if queue.auto_delete and not queue.consumers:
+            self.delete_queue(queue.name)
+
+    def delete_queue(self, name):
+        del self.queues[name]
+        for exchange in self.exchanges.values():
+            exchange.bindings = [binding for binding in exchange.bindings if binding[0] != name]
+
+
+class Consumer(object):
+    """
+    a consumer on a queue, registered by basic_consume
+    """
+
+    def __init__(self, channel, queue, callback, no_ack, tag):
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+        self.tag = tag
+        self.unacked = 0
+
+    def ready(self):
+        """
+        :return: True if the prefetch window of the consumer has room for another message. As with rabbitmq, the
+        prefetch count set by basic_qos applies to every consumer on the channel separately
+        """
+        return self.no_ack or not self.channel.prefetch_count or self.unacked < self.channel.prefetch_count
+
+    def deliver(self, message):
+        if not self.no_ack:
+            self.unacked += 1
+        self.channel.deliver(self, message)
+
+
+class IOLoop(object):
+    """
+    the ioloop of a connection. It runs scheduled callbacks and timeouts in order, until stopped or out of work
+    """
+
+    def __init__(self):
+        self._ready = collections.deque()
+        self._timeouts = []
+        self._cancelled = set()
+        self._handles = itertools.count()
+        self._threadsafe = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def add_timeout(self, deadline, callback):
+        handle = next(self._handles)
+        heapq.heappush(self._timeouts, (time.time() + deadline, handle, callback))
+        return handle
+
+    def remove_timeout(self, handle):
+        self._cancelled.add(handle)
+
+    def add_callback_threadsafe(self, callback):
+        with self._lock:
+            self._threadsafe.append(callback)
+            self._wakeup.notify()
+
+    def start(self):
+        """
+        runs the loop until stop is called, or there is nothing left to do
+
+        :return: None
+        """
+        self._stopping = False
+        while not self._stopping:
+            if self._threadsafe:
+                with self._lock:
+                    self._ready.extend((callback, ()) for callback in self._threadsafe)
+                    self._threadsafe.clear()
+            if self._ready:
+                callback, args = self._ready.popleft()
+                callback(*args)
+            elif self._timeouts:
+                deadline, handle, callback = self._timeouts[0]
+                if handle in self._cancelled:
+                    heapq.heappop(self._timeouts)
+                    self._cancelled.discard(handle)
+                    continue
+                delay = deadline - time.time()
+                if delay > 0:
+                    # wait for the timeout, unless another thread has work for us first
+                    with self._lock:
+                        if not self._threadsafe:
+                            self._wakeup.wait(delay)
+                    continue
+                heapq.heappop(self._timeouts)
+                callback()
+            elif not self._threadsafe:
+                return
+
+    def stop(self):
+        self._stopping = True
+
+
+class Connection(object):
+    """
+    a connection to the in-process broker, mimicking pika.SelectConnection
+    """
+
+    def __init__(self, broker, on_open_callback, on_close_callback, stop_ioloop_on_close):
+        self.broker = broker
+        self.ioloop = IOLoop()
+        self.is_open = False
+        self.is_closed = True
+        self._on_open_callback = on_open_callback
+        self._close_callbacks = [on_close_callback] if on_close_callback else []
+        self._stop_ioloop_on_close = stop_ioloop_on_close
+        self._channels = {}
+        self._channel_numbers = itertools.count(1)
+        self.connect()
+
+    def connect(self):
+        """
+        (re)opens the connection. The open callback is called from the ioloop
+
+        :return: None
+        """
+        self.is_open = True
+        self.is_closed = False
+        if self._on_open_callback is not None:
+            self.ioloop.call_soon(self._on_open_callback, self)
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        return self.ioloop.add_timeout(deadline, callback)
+
+    def remove_timeout(self, handle):
+        self.ioloop.remove_timeout(handle)
+
+    def add_callback_threadsafe(self, callback):
+        self.ioloop.add_callback_threadsafe(callback)
+
+    def channel(self, on_open_callback, channel_number=None):
+        """
+        opens a channel on the connection
+
+        :param on_open_callback: called with the channel once it is open
+        :param channel_number: the number of the channel. Picked automatically if not set
+        :return: the channel
+        """
+        if channel_number is None:
+            channel_number = next(self._channel_numbers)
+        channel = Channel(self, channel_number)
+        self._channels[channel_number] = channel
+        self.ioloop.call_soon(on_open_callback, channel)
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        """
+        closes every channel, and then the connection itself
+
+        :param reply_code: the reason for closing
+        :param reply_text: the corresponding text
+        :return: None
+        """
+        if not self.is_open:
+            return
+        for channel in list(self._channels.values()):
+            channel.close(reply_code, reply_text)
+        self.is_open = False
+        self.ioloop.call_soon(self._on_closed, reply_code, reply_text)
+
+    def _on_closed(self, reply_code, reply_text):
+        self.is_closed = True
+        for callback in self._close_callbacks:
+            callback(self, reply_code, reply_text)
+        if self._stop_ioloop_on_close:
+            self.ioloop.stop()
+
+
+class Channel(object):
+    """
+    a channel on a connection, mimicking pika.channel.Channel. Only the methods ASynQ uses are implemented
+    """
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.broker = connection.broker
+        self.is_open = True
+        self.is_closed = False
+        self.prefetch_count = 0
+        self.unacked = collections.OrderedDict()
+
+        self._confirm_callback = None
+        self._publish_number = 0
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._consumers = {}
+        self._close_callbacks = []
+        self._cancel_callbacks = []
+
+    def __int__(self):
+        return self.channel_number
+
+    # helpers for replying from the ioloop, the way the server would
+
+    def _reply(self, callback, method):
+        if callback is not None:
+            self.connection.ioloop.call_soon(callback, frame.Method(self.channel_number, method))
+
+    def _rpc(self, operation, *args):
+        """
+        runs an operation on the broker. Protocol errors close the channel, as rabbitmq does
+        """
+        if not self.is_open:
+            raise exceptions.ChannelClosed('channel %i is closed' % self.channel_number)
+        try:
+            return operation(*args)
+        except ChannelError as error:
+            logger.warning('closing channel %i: %s', self.channel_number, error.reply_text)
+            self.close(error.reply_code, error.reply_text)
+            return None
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._cancel_callbacks.append(callback)
+
+    def exchange_declare(self, callback=None, exchange=None, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, nowait=False, arguments=None):
+        if self._rpc(self.broker.declare_exchange, exchange, exchange_type, passive) is not None:
+            self._reply(callback, spec.Exchange.DeclareOk())
+
+    def queue_declare(self, callback, queue='', passive=False, durable=False, exclusive=False, auto_delete=False,
+                      nowait=False, arguments=None):
+        declared = self._rpc(self.broker.declare_queue, queue, passive, auto_delete, arguments)
+        if declared is not None:
+            self._reply(callback, spec.Queue.DeclareOk(declared.name, len(declared),
+                                                       len(declared.consumers)))
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None, nowait=False, arguments=None):
+        if self._rpc(self.broker.bind, queue, exchange, routing_key or queue) is not None:
+            self._reply(callback, spec.Queue.BindOk())
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self._confirm_callback = callback
+
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self.prefetch_count = prefetch_count
+        self._reply(callback, spec.Basic.QosOk())
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self._rpc(self.broker.publish, exchange, routing_key, body, properties or pika.BasicProperties(),
+                  self.connection.ioloop)
+        if self.is_open and self._confirm_callback is not None:
+            self._publish_number += 1
+            self._reply(self._confirm_callback, spec.Basic.Ack(self._publish_number))
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False, exclusive=False, consumer_tag=None,
+                      arguments=None):
+        if queue not in self.broker.queues:
+            self._rpc(self.broker.declare_queue, queue, True, False, None)
+            return None
+        if consumer_tag is None:
+            consumer_tag = 'ctag%i.%i' % (self.channel_number, next(self._consumer_tags))
+        consumer = Consumer(self, queue, consumer_callback, no_ack, consumer_tag)
+        self._consumers[consumer_tag] = consumer
+        declared = self.broker.queues[queue]
+        declared.consumers.append(consumer)
+        self.connection.ioloop.call_soon(self.broker.dispatch, declared)
+        return consumer_tag
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            self.broker.remove_consumer(consumer)
+        self._reply(callback, spec.Basic.CancelOk(consumer_tag))
+
+    def deliver(self, consumer, message):
+        """
+        called by the broker, when a message is handed to consumer. The consumer callback is called from the ioloop
+        """
+        delivery_tag = next(self._delivery_tags)
+        if not consumer.no_ack:
+            self.unacked[delivery_tag] = (consumer, message)
+        method = spec.Basic.Deliver(consumer.tag, delivery_tag, message.redelivered, message.exchange,
+                                    message.routing_key)
+        self.connection.ioloop.call_soon(self._on_deliver, consumer, method, message)
+
+    def _on_deliver(self, consumer, method, message):
+        if self.is_open and consumer.tag in self._consumers:
+            consumer.callback(self, method, message.properties, message.body)
+
+    def _settle(self, delivery_tag, multiple):
+        """
+        removes delivery_tag (and with multiple, every tag before it) from the unacked messages
+
+        :return: a list of (queue, message) pairs that were settled
+        """
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag or delivery_tag == 0]
+        elif delivery_tag in self.unacked:
+            tags = [delivery_tag]
+        else:
+            raise ChannelError(406, 'PRECONDITION_FAILED - unknown delivery tag %i' % delivery_tag)
+        settled = [self._unack(tag) for tag in tags]
+        # room in the prefetch window
+        for queue in set(queue for queue, _ in settled):
+            if queue in self.broker.queues:
+                self.broker.dispatch(self.broker.queues[queue])
+        return settled
+
+    def _unack(self, delivery_tag):
+        consumer, message = self.unacked.pop(delivery_tag)
+        consumer.unacked -= 1
+        return consumer.queue, message
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._rpc(self._settle, delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        settled = self._rpc(self._settle, delivery_tag or 0, multiple)
+        if settled and requeue:
+            self._requeue(settled)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.basic_nack(delivery_tag, False, requeue)
+
+    def _requeue(self, settled):
+        by_queue = collections.OrderedDict()
+        for queue, message in settled:
+            by_queue.setdefault(queue, []).append(message)
+        for queue, messages in by_queue.items():
+            self.broker.requeue(queue, messages)
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        """
+        closes the channel. Consumers are removed, and unacked messages are put back on their queues
+
+        :param reply_code: the reason for closing
+        :param reply_text: the corresponding text
+        :return: None
+        """
+        if not self.is_open:
+            return
+        self.is_open = False
+        for consumer in self._consumers.values():
+            self.broker.remove_consumer(consumer)
+        self._consumers.clear()
+        settled = [self._unack(tag) for tag in list(self.unacked)]
+        self._requeue(settled)
+        self.connection.ioloop.call_soon(self._on_closed, reply_code, reply_text)
+
+    def _on_closed(self, reply_code, reply_text):
+        self.is_closed = True
+        self.connection._channels.pop(self.channel_number, None)
+        for callback in self._close_callbacks:
+            callback(self, reply_code, reply_text)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import cProfile
+import json
+import logging
+import os
+import signal
+import time
+
+
+class Profiler(object):
+    """
+    this class implements the opt in profiling of a consumer. It is handed to ASynQ.serve, which calls enter and leave
+    around every process_message invocation. Sampled invocations are run under cProfile and split into phases, and the
+    aggregated statistics are dumped to disk every now and then, so a live consumer can be inspected without a restart
+    """
+
+    def __init__(self, dump_dir='.', every=0, signum=signal.SIGUSR1, window=30, dump_every=1000):
+        """
+        sets up the profiler. Invocations are sampled if they are every'th invocation, or if they happen within window
+        seconds after the process received the signal signum
+
+        :param dump_dir: the directory the pstats and phase dumps are written to
+        :param every: profile every every'th invocation of process_message. 0 disables counting based sampling
+        :param signum: the signal that opens a profiling window. None disables signal based sampling
+        :param window: the number of seconds everything is profiled after signum is received
+        :param dump_every: the number of profiled invocations between dumps to disk
+        """
+        self.dump_dir = dump_dir
+        self.every = every
+        self.signum = signum
+        self.window = window
+        self.dump_every = dump_every
+
+        self.logger = logging.getLogger(__name__)
+
+        # the phases of an invocation: the time spent outside process_message since the last invocation returned
+        # (pika framing, network and idle time), and then the ack, decode and callback phases within process_message
+        self.phases = {'wait': 0.0, 'ack': 0.0, 'decode': 0.0, 'callback': 0.0}
+        self.active = False
+        self.invocations = 0
+        self.profiled = 0
+
+        self._profile = cProfile.Profile()
+        self._window_end = 0.0
+        self._left = None
+        self._mark = 0.0
+
+    def install(self):
+        """
+        installs the signal handler which opens a profiling window. This must be called from the main thread
+
+        :return: None
+        """
+        if self.signum is not None:
+            signal.signal(self.signum, self.on_signal)
+
+    def on_signal(self, signum, frame):
+        """
+        this is called when the profiling signal is received. It (re)opens the profiling window
+
+        :param signum: the signal received
+        :param frame: not used
+        :return: None
+        """
+        self._window_end = time.time() + self.window
+        self.logger.warning('profiling all messages for %i seconds', self.window)
+
+    def enter(self):
+        """
+        this is called when process_message is entered. It decides whether this invocation is sampled, and if so starts
+        the profiler
+
+        :return: None
+        """
+        now = time.perf_counter()
+        self.invocations += 1
+        self.active = bool(self.every and self.invocations % self.every == 0) or time.time() < self._window_end
+        if self.active:
+            if self._left is not None:
+                self.phases['wait'] += now - self._left
+            self._mark = now
+            self._profile.enable()
+
+    def mark(self, phase):
+        """
+        attributes the time since the last mark (or since enter) to phase
+
+        :param phase: the name of the phase that just ended
+        :return: None
+        """
+        now = time.perf_counter()
+        self.phases[phase] += now - self._mark
+        self._mark = now
+
+    def leave(self):
+        """
+        this is called when process_message returns. It stops the profiler, and dumps the statistics if it is time to
+
+        :return: None
+        """
+        if self.active:
+            self._profile.disable()
+            self.active = False
+            self.profiled += 1
+            if self.profiled % self.dump_every == 0:
+                self.dump()
+        self._left = time.perf_counter()
+
+    def dump(self):
+        """
+        writes the aggregated pstats and the phase timings to dump_dir. The files are named by pid, so several
+        consumers can share the directory
+
+        :return: None
+        """
+        if not self.profiled:
+            return
+        base = os.path.join(self.dump_dir, 'asynq-%i' % os.getpid())
+        self._profile.dump_stats(base + '.pstats')
+        with open(base + '.phases.json', 'w') as f:
+            json.dump({'invocations': self.invocations, 'profiled': self.profiled, 'phases': self.phases}, f)
+        self.logger.info('dumped profile of %i invocations to %s', self.profiled, base)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Memoization of idempotent rpc handlers, for consumers in the style of full_test_downstream.py. A ResponseCache turns a
+handler of request bodies into an ASynQ callback, which replies from the cache when it can:
+
+    cache = rpccache.ResponseCache(lookup, rpccache.otq_reply(url), key=lambda body: json.loads(body)['hej'],
+                                   reply_to=lambda properties, body: json.loads(body)['uuid'], workers=4)
+    rec.serve(cache.callback)
+
+With workers, handlers run in a thread pool, and identical requests arriving while one is being handled wait for its
+response instead of running the handler again. A handler raising fails the request (and every request waiting for it)
+the same way with or without workers: the ASynQ retries or dead letters it, if set up to.
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from concurrent import futures
+
+from asynq import asynq
+
+
+def otq_reply(url, **kwargs):
+    """
+    :param url: url of the amqp server
+    :param kwargs: further arguments for the ASynQ sending the reply (e.g. transport)
+    :return: a reply function sending the response to the one time queue named by the request, as otqcallback does
+    """
+    def reply(routing_key, response):
+        asynq.ASynQ(url=url, routing_key=routing_key, sender=True, otq=True, **kwargs).client(response)
+    return reply
+
+
+class ResponseCache(object):
+    """
+    this class implements a size bounded lru cache, with a time to live per entry, in front of an rpc handler
+    """
+
+    def __init__(self, handler, reply, key=None, reply_to=None, maxsize=10000, ttl=60, workers=0):
+        """
+        :param handler: the rpc handler. It is called with the request body, and returns the response (anything
+        ASynQ.client accepts)
+        :param reply: a function of (routing key, response) sending the response. See otq_reply
+        :param key: a function of the request body returning the cache key. Defaults to a hash of the body
+        :param reply_to: a function of (properties, body) returning the routing key of the reply. Defaults to the
+        reply_to property of the request
+        :param maxsize: the number of responses kept
+        :param ttl: the number of seconds a response is kept
+        :param workers: the number of threads running the handler. 0 runs it in the consumer, one request at a time
+        """
+        self.handler = handler
+        self.reply = reply
+        self.key = key or (lambda body: hashlib.sha1(body).digest())
+        self.reply_to = reply_to or (lambda properties, body: properties.reply_to)
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+        self.failures = 0
+
+        self.logger = logging.getLogger(__name__)
+        self._responses = OrderedDict()
+        self._inflight = {}
+        self._executor = futures.ThreadPoolExecutor(workers) if workers else None
+
+    def stats(self):
+        """
+        :return: a dict of the hit, miss, collapsed, eviction and failure counters, and the number of cached responses
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'collapsed': self.collapsed, 'evictions': self.evictions,
+                'failures': self.failures, 'size': len(self._responses)}
+
+    def lookup(self, key):
+        """
+        :param key: the cache key
+        :return: the cached response for key, or None if there is none (or it has expired)
+        """
+        entry = self._responses.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires < time.time():
+            del self._responses[key]
+            return None
+        self._responses.move_to_end(key)
+        return response
+
+    def store(self, key, response):
+        self._responses[key] = (time.time() + self.ttl, response)
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.maxsize:
+            self._responses.popitem(last=False)
+            self.evictions += 1
+
+    def callback(self, channel, method, properties, body):
+        """
+        the ASynQ callback. It replies from the cache, joins a request for the same key in flight, or runs the handler
+
+        :param channel: the channel
+        :param method: method parameters
+        :param properties: properties
+        :param body: the body
+        :return: the future of the handler, if it was handed to a worker, and otherwise None. A request joining one in
+        flight gets the future of that
+        """
+        key = self.key(body)
+        routing_key = self.reply_to(properties, body)
+
+        response = self.lookup(key)
+        if response is not None:
+            self.hits += 1
+            self.reply(routing_key, response)
+            return
+
+        if key in self._inflight:
+            self.collapsed += 1
+            future, waiters = self._inflight[key]
+            waiters.append(routing_key)
+            return future
+
+        self.misses += 1
+        if self._executor is None:
+            try:
+                response = self.handler(body)
+            except Exception:
+                self.failures += 1
+                raise
+            self.complete(key, [routing_key], response)
+            return
+
+        future = self._executor.submit(self.handler, body)
+        self._inflight[key] = (future, [routing_key])
+        # the reply must be sent from the ioloop thread, not the worker
+        future.add_done_callback(
+            lambda done: channel.connection.add_callback_threadsafe(lambda: self.on_done(key, done)))
+        # the consumer finishes the request (or fails it) when the future is done, see ASynQ.track
+        return future
+
+    def on_done(self, key, future):
+        """
+        this is called on the ioloop when a handler running in a worker is done
+
+        :param key: the cache key of the request
+        :param future: the future of the handler
+        :return: None
+        """
+        _, waiters = self._inflight.pop(key)
+        if future.exception() is not None:
+            # the consumer fails every request waiting for this one, as the future is theirs too
+            self.failures += len(waiters)
+            self.logger.error('rpc handler failed for %i requests: %r', len(waiters), future.exception())
+            return
+        self.complete(key, waiters, future.result())
+
+    def complete(self, key, waiters, response):
+        """
+        caches the response, and sends it to everyone waiting for it
+
+        :param key: the cache key
+        :param waiters: the routing keys to reply to
+        :param response: the response
+        :return: None
+        """
+        self.store(key, response)
+        for routing_key in waiters:
+            self.reply(routing_key, response)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Typed decoding of message bodies. A Schema compiles a class with __slots__ for its fields, and a decoder validating
+and filling them in one generated function. Handed to an ASynQ by routing key or content type, it decodes bodies
+before the callback sees them:
+
+    request = schema.Schema('Request', [('hej', str), ('uuid', str)])
+    rec = asynq.ASynQ(url, routing_key='norm_queue', schemas={'norm_queue': request})
+
+so the callback gets a Request instead of bytes. Schema.columns turns a batch of bodies into one array per field.
+"""
+import json
+from array import array
+
+# the array typecodes used for columns of these types. Other types become lists
+TYPECODES = {int: 'q', float: 'd', bool: 'b'}
+MISSING = object()
+
+
+class SchemaError(ValueError):
+    """
+    raised when a body does not match its schema
+    """
+
+
+class Record(object):
+    """
+    the base of the classes compiled by Schema
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (field, getattr(self, field)) for field in self.__slots__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def _asdict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Schema(object):
+    """
+    this class compiles a message schema: a record class, and a decoder from json bodies to records
+    """
+
+    def __init__(self, name, fields):
+        """
+        :param name: the name of the record class
+        :param fields: a list of (field, type) or (field, type, default) tuples. A field must be present in the body
+        and of its type (an int is accepted for a float), unless it has a default. Field names become attributes of
+        the records, so they must be identifiers (keywords such as class are fine, and read with getattr)
+        """
+        self.name = name
+        self.fields = [(field[0], field[1], field[2] if len(field) > 2 else MISSING) for field in fields]
+        for field, _, _ in self.fields:
+            if not isinstance(field, str) or not field.isidentifier():
+                raise ValueError('%s: field name %r is not an identifier' % (name, field))
+        self.record = type(name, (Record,), {'__slots__': tuple(field for field, _, _ in self.fields)})
+        self.decode_dict = self._compile()
+
+    def _compile(self):
+        """
+        generates the function checking a decoded dict and building a record from it, with one straight line of
+        checks per field. Names and messages are handed to the generated code in its namespace, never pasted into it,
+        so any field name works (keywords included)
+
+        :return: the function
+        """
+        lines = ['def decode_dict(data):',
+                 '    if type(data) is not dict:',
+                 '        raise SchemaError(not_object + type(data).__name__)',
+                 '    record = new(Record)']
+        namespace = {'SchemaError': SchemaError, 'new': object.__new__, 'Record': self.record, 'MISSING': MISSING,
+                     'not_object': '%s: expected an object, got ' % self.name}
+        for i, (field, kind, default) in enumerate(self.fields):
+            namespace['field_%i' % i] = field
+            namespace['kind_%i' % i] = kind
+            namespace['default_%i' % i] = default
+            namespace['missing_%i' % i] = '%s: missing field %s' % (self.name, field)
+            namespace['mistyped_%i' % i] = '%s: field %s should be %s, got ' % (self.name, field, kind.__name__)
+            # the slot descriptor sets the attribute as fast as record.field = value would
+            namespace['set_%i' % i] = self.record.__dict__[field].__set__
+            lines.append('    value = data.get(field_%i, default_%i)' % (i, i))
+            lines.append('    if value is MISSING:')
+            lines.append('        raise SchemaError(missing_%i)' % i)
+            # bool is a subclass of int, so the checks are on exact types
+            accepted = '(kind_%i, int)' % i if kind is float else '(kind_%i,)' % i
+            lines.append('    if type(value) not in %s and value is not default_%i:' % (accepted, i))
+            lines.append('        raise SchemaError(mistyped_%i + type(value).__name__)' % i)
+            lines.append('    set_%i(record, value)' % i)
+        lines.append('    return record')
+        exec('\n'.join(lines), namespace)
+        return namespace['decode_dict']
+
+    def decode(self, body):
+        """
+        decodes a json body into a record
+
+        :param body: the body, as bytes
+        :return: the record
+        """
+        try:
+            data = json.loads(body)
+        except ValueError as error:
+            raise SchemaError('%s: %s' % (self.name, error))
+        return self.decode_dict(data)
+
+    def columns(self, bodies):
+        """
+        decodes a batch of bodies into one column per field. Fields of type int, float and bool become arrays, the
+        rest lists. So do fields with a default of None, as an array cannot hold None
+
+        :param bodies: an iterable of bodies
+        :return: a dict of columns by field
+        """
+        columns = {field: array(TYPECODES[kind]) if kind in TYPECODES and default is not None else []
+                   for field, kind, default in self.fields}
+        appends = [(field, columns[field].append) for field, _, _ in self.fields]
+        for body in bodies:
+            record = self.decode(body)
+            for field, append in appends:
+                append(getattr(record, field))
+        return columns
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import collections
+import json
+import unittest
+
+from pika import frame, spec
+
+from asynq import asynq
+from support import URL, MemoryTestCase
+
+
+class Burst(asynq.ASynQ):
+    """
+    a sender publishing all its messages before any confirm comes back, as a busy sender on a real broker does, and
+    noting the channel every message went out on
+    """
+
+    def __init__(self, messages, *args, **kwargs):
+        super(Burst, self).__init__(*args, **kwargs)
+        self.burst = messages
+        self.picked = []
+
+    def start_sending(self):
+        self._messages = iter(())
+        for message in self.burst:
+            self.message = message
+            self.send()
+        self._done_sending = True
+
+    def pick_channel(self, ordering_key=None):
+        channel = super(Burst, self).pick_channel(ordering_key)
+        self.picked.append((ordering_key, channel.channel_number))
+        return channel
+
+
+class ChannelTest(MemoryTestCase):
+
+    def burst(self, messages, ordering_key=None, **kwargs):
+        sender = Burst(messages, url=URL, routing_key='asynq_test', transport=self.broker.connect, sender=True,
+                       channels=4, **kwargs)
+        # as stream sets it
+        sender._ordering_key = ordering_key
+        sender.run()
+        return sender
+
+    def channels_by_key(self, sender):
+        channels = collections.defaultdict(set)
+        for key, number in sender.picked:
+            channels[key].add(number)
+        return channels
+
+    def test_messages_are_spread_over_the_channels(self):
+        sender = self.burst(range(40))
+        self.assertEqual(sender._published, {1: 10, 2: 10, 3: 10, 4: 10})
+        self.assertEqual((sender._acked, sender._outstanding), (40, 0))
+        self.assertEqual(self.broker.queue_length('asynq_test'), 40)
+
+    def test_ordered_by_routing_key_stays_on_one_channel(self):
+        sender = self.burst(range(40), ordered=True)
+        self.assertEqual(sender._published, {1: 40})
+
+    def test_ordering_keys_are_spread_and_kept_in_order(self):
+        sender = self.burst([{'key': i % 3, 'seq': i} for i in range(30)], lambda message: message['key'])
+        channels = self.channels_by_key(sender)
+        # every key on a channel of its own
+        self.assertEqual([len(numbers) for numbers in channels.values()], [1, 1, 1])
+        self.assertEqual(len(set.union(*channels.values())), 3)
+        self.assertEqual(sender._sticky, {})
+
+        received = [json.loads(body) for body in self.consume('asynq_test')]
+        for key in range(3):
+            self.assertEqual([m['seq'] for m in received if m['key'] == key], list(range(key, 30, 3)))
+
+    def test_ordering_keys_without_confirms_go_by_hash(self):
+        sender = self.burst([{'key': i % 3} for i in range(30)], lambda message: message['key'], acked=False)
+        self.assertEqual([len(numbers) for numbers in self.channels_by_key(sender).values()], [1, 1, 1])
+        self.assertEqual(sum(sender._published.values()), 30)
+        self.assertEqual((sender._deliveries, sender._sticky), ({}, {}))
+
+    def test_confirms_are_settled_per_channel(self):
+        sender = self.queue('asynq_test', sender=True)
+        sender._messages = iter(())
+        sender._deliveries = {1: collections.deque([1, 2, 3]), 2: collections.deque([1, 2])}
+        sender._outstanding = 5
+
+        sender.on_delivery_confirmation(frame.Method(2, spec.Basic.Ack(2, multiple=True)))
+        self.assertEqual({n: list(tags) for n, tags in sender._deliveries.items()}, {1: [1, 2, 3], 2: []})
+        sender.on_delivery_confirmation(frame.Method(1, spec.Basic.Nack(1)))
+        self.assertEqual((sender._acked, sender._nacked, sender._outstanding), (2, 1, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+import json
+import unittest
+
+from support import MemoryTestCase
+
+
+class CoalesceTest(MemoryTestCase):
+
+    def serve(self, **kwargs):
+        self.consumer = self.queue('prices', **kwargs)
+        received = []
+        self.consumer.serve(lambda channel, method, properties, body: received.append(json.loads(body)))
+        return received
+
+    def test_only_the_newest_message_per_key_is_handled(self):
+        self.send('prices', [{'v': i} for i in range(6)], headers={'symbol': 'ABC'})
+        self.send('prices', [{'v': 10}], headers={'symbol': 'XYZ'})
+
+        self.assertEqual(self.serve(coalesce='symbol'), [{'v': 5}, {'v': 10}])
+        self.assertEqual(self.consumer.coalesced, 5)
+        # the superseded messages are acknowledged along with the rest
+        self.assertEqual(self.broker.queue_length('prices'), 0)
+        self.assertEqual(len(self.consumer._channel.unacked), 0)
+
+    def test_key_function(self):
+        self.send('prices', [{'symbol': 'ABC', 'v': i} for i in range(3)])
+        received = self.serve(coalesce=lambda properties, body: json.loads(body)['symbol'])
+        self.assertEqual(received, [{'symbol': 'ABC', 'v': 2}])
+
+    def test_messages_without_a_key_are_all_handled(self):
+        self.send('prices', [{'v': i} for i in range(3)])
+        self.assertEqual(self.serve(coalesce='symbol'), [{'v': i} for i in range(3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
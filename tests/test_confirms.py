@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import collections
+import unittest
+
+from pika import frame, spec
+
+from support import MemoryTestCase
+
+
+def ack(channel_number, delivery_tag, multiple=False):
+    return frame.Method(channel_number, spec.Basic.Ack(delivery_tag, multiple))
+
+
+class ConfirmTest(MemoryTestCase):
+
+    def test_nothing_is_tracked_without_confirms(self):
+        sender = self.send('asynq_test', range(5000), acked=False)
+        self.assertEqual(sender._message_number, 5000)
+        self.assertEqual(sender._deliveries, {})
+        self.assertEqual(sender._outstanding, 0)
+        self.assertEqual(self.broker.queue_length('asynq_test'), 5000)
+
+    def test_every_message_is_confirmed(self):
+        sender = self.send('asynq_test', range(100))
+        self.assertEqual(sender._acked, 100)
+        self.assertEqual(sender._outstanding, 0)
+        self.assertFalse(any(sender._deliveries.values()))
+
+    def test_multiple_confirms_settle_everything_up_to_their_tag(self):
+        sender = self.queue('asynq_test', sender=True)
+        sender._done_sending = False
+        sender._messages = iter(())
+        sender._deliveries = {1: collections.deque([1, 2, 3, 4, 5])}
+        sender._outstanding = 5
+
+        sender.on_delivery_confirmation(ack(1, 3, multiple=True))
+        self.assertEqual(list(sender._deliveries[1]), [4, 5])
+        self.assertEqual(sender._acked, 3)
+
+        # a single confirm out of order
+        sender.on_delivery_confirmation(ack(1, 5))
+        self.assertEqual(list(sender._deliveries[1]), [4])
+        self.assertEqual(sender._outstanding, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
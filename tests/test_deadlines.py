@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import os
+import time
+import unittest
+
+import pika
+
+from asynq import dedup, recording
+from support import MemoryTestCase
+
+
+def past(seconds):
+    """
+    :return: the x-deadline or x-timestamp header value of seconds ago
+    """
+    return int((time.time() - seconds) * 1000)
+
+
+class DeadlineTest(MemoryTestCase):
+
+    def serve(self, routing_key, **kwargs):
+        """
+        consumes routing_key until it is drained
+
+        :return: the consumer and the bodies it handled
+        """
+        received = []
+        consumer = self.queue(routing_key, **kwargs)
+        consumer.serve(lambda channel, method, properties, body: received.append(body))
+        return consumer, received
+
+    def test_messages_past_their_deadline_are_dropped(self):
+        self.send('dl', ['late'], headers={'x-deadline': past(1)})
+        self.send('dl', ['in time'], ttl=60)
+        consumer, received = self.serve('dl')
+        self.assertEqual(received, [b'in time'])
+        self.assertEqual(consumer.expired, 1)
+        self.assertEqual(len(consumer._channel.unacked), 0)
+
+    def test_messages_older_than_max_age_are_dropped(self):
+        self.send('age', ['old'])
+        time.sleep(0.05)
+        consumer, received = self.serve('age', max_age=0.02)
+        self.assertEqual((received, consumer.expired), ([], 1))
+
+    def test_messages_younger_than_max_age_are_handled(self):
+        self.send('age', ['new'])
+        consumer, received = self.serve('age', max_age=60)
+        self.assertEqual((received, consumer.expired), ([b'new'], 0))
+
+    def test_the_broker_expires_messages_by_ttl(self):
+        self.send('exp', ['gone'], ttl=0.01)
+        time.sleep(0.03)
+        self.send('exp', ['kept'], ttl=60)
+        consumer, received = self.serve('exp')
+        self.assertEqual(received, [b'kept'])
+        # the consumer never saw the expired message
+        self.assertEqual(consumer.expired, 0)
+
+    def test_one_time_queue_consumer_stops_on_a_stale_message(self):
+        self.queue('otq_stale', sender=True, otq=True, headers={'x-deadline': past(1)}).client('late')
+        self.queue('otq_stale', sender=True, otq=True).client('fresh')
+        consumer, received = self.serve('otq_stale', otq=True)
+        self.assertEqual((received, consumer.expired), ([], 1))
+        self.assertNotIn('otq_stale', self.broker.queues)
+
+    def test_one_time_queue_consumer_stops_on_a_duplicate(self):
+        self.queue('otq_dup', sender=True, otq=True).client('seen')
+        self.queue('otq_dup', sender=True, otq=True).client('fresh')
+        cache = dedup.DedupCache()
+        cache.add(self.broker.queues['otq_dup'].levels[0][0].properties.message_id)
+
+        received = []
+        self.queue('otq_dup', otq=True).serve(lambda channel, method, properties, body: received.append(body),
+                                              dedup=cache)
+        self.assertEqual((received, cache.hits), ([], 1))
+        self.assertNotIn('otq_dup', self.broker.queues)
+
+
+class RestampTest(MemoryTestCase):
+
+    def setUp(self):
+        super(RestampTest, self).setUp()
+        self.path = os.path.join(self.tempdir(), 'traffic.log')
+
+    def test_restamp_keeps_the_time_to_the_deadline(self):
+        sent = past(3600)
+        properties = pika.BasicProperties(timestamp=sent // 1000,
+                                          headers={'x-timestamp': sent, 'x-deadline': sent + 5000, 'other': 'kept'})
+        restamped = recording.Replayer.restamp(time.time() - 3600, properties)
+        headers = restamped.headers
+        self.assertAlmostEqual(headers['x-timestamp'], time.time() * 1000, delta=1000)
+        self.assertEqual(headers['x-deadline'] - headers['x-timestamp'], 5000)
+        self.assertEqual(headers['other'], 'kept')
+        self.assertAlmostEqual(restamped.timestamp, time.time(), delta=1)
+        # the recorded properties are left alone
+        self.assertEqual(properties.headers['x-timestamp'], sent)
+
+    def test_restamp_uses_the_arrival_without_a_send_time(self):
+        arrival = time.time() - 3600
+        properties = pika.BasicProperties(headers={'x-deadline': int(arrival * 1000) + 5000})
+        headers = recording.Replayer.restamp(arrival, properties).headers
+        self.assertEqual(headers['x-deadline'] - headers['x-timestamp'], 5000)
+
+    def test_old_logs_replay_into_consumers_dropping_stale_messages(self):
+        sent = past(3600)
+        recorder = recording.Recorder(self.path, chunk=1024)
+        recorder.record('src', pika.BasicProperties(headers={'x-timestamp': sent}), b'aged')
+        recorder.record('src', pika.BasicProperties(headers={'x-timestamp': sent, 'x-deadline': sent + 5000}),
+                        b'deadline')
+        recorder.close()
+
+        recording.Replayer(url='amqp://localhost/', routing_key='dst', transport=self.broker.connect,
+                           speed=0).replay(self.path)
+        received = []
+        consumer = self.queue('dst', max_age=60)
+        consumer.serve(lambda channel, method, properties, body: received.append(body))
+        self.assertEqual(received, [b'aged', b'deadline'])
+        self.assertEqual(consumer.expired, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import os
+import time
+import unittest
+
+import pika
+
+from asynq import dedup
+from support import MemoryTestCase
+
+
+class DedupTest(MemoryTestCase):
+
+    def test_redelivered_messages_are_skipped(self):
+        self.send('asynq_test', ['first'])
+        for _ in range(2):
+            self.broker.publish('yacamc_exchange', 'asynq_test', b'again', pika.BasicProperties(message_id='same'))
+
+        cache = dedup.DedupCache()
+        received = []
+        self.queue('asynq_test').serve(lambda channel, method, properties, body: received.append(body), dedup=cache)
+        self.assertEqual(received, [b'first', b'again'])
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(self.broker.queue_length('asynq_test'), 0)
+
+    def test_cache_forgets_the_oldest_and_the_expired(self):
+        cache = dedup.DedupCache(maxsize=2, ttl=0.05)
+        for message_id in ('a', 'b', 'c'):
+            cache.add(message_id)
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+        time.sleep(0.06)
+        self.assertNotIn('c', cache)
+
+    def test_shared_index_is_shared_between_processes(self):
+        path = os.path.join(self.tempdir(), 'dedup.index')
+        writer = dedup.SharedIndex(path, slots=64)
+        self.addCleanup(writer.close)
+        reader = dedup.SharedIndex(path, slots=64)
+        self.addCleanup(reader.close)
+
+        writer.add('m1', time.time() + 60)
+        writer.add('m2', time.time() - 1)
+        self.assertIn('m1', reader)
+        self.assertNotIn('m2', reader)
+        self.assertNotIn('m3', reader)
+        self.assertIn('m1', dedup.DedupCache(shared=reader))
+
+    def test_shared_index_evicts_the_oldest_when_its_probes_are_full(self):
+        index = dedup.SharedIndex(os.path.join(self.tempdir(), 'dedup.index'), slots=2, probes=2)
+        self.addCleanup(index.close)
+        now = time.time()
+        index.add('old', now + 10)
+        index.add('new', now + 20)
+        index.add('newer', now + 30)
+        self.assertNotIn('old', index)
+        self.assertIn('new', index)
+        self.assertIn('newer', index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import json
+import unittest
+
+from support import MemoryTestCase
+
+
+class PriorityTest(MemoryTestCase):
+
+    def test_higher_priority_overtakes(self):
+        self.send('pq', [{'bulk': i} for i in range(5)], max_priority=5)
+        self.queue('pq', sender=True, max_priority=5).client({'urgent': 1}, priority=5)
+        received = self.consume('pq', max_priority=5, prefetch_count=1)
+        self.assertEqual(json.loads(received[0]), {'urgent': 1})
+        self.assertEqual([json.loads(body) for body in received[1:]], [{'bulk': i} for i in range(5)])
+
+
+class LaneTest(MemoryTestCase):
+
+    def test_lanes_are_served_weighted_round_robin(self):
+        self.send('ctl.bulk', range(20))
+        self.send('ctl.urgent', range(20))
+
+        lanes = []
+        self.queue('ctl', lanes=[('urgent', 3), ('bulk', 1)], prefetch_count=8).serve(
+            lambda channel, method, properties, body: lanes.append(method.routing_key.split('.')[1][0]))
+        self.assertEqual(len(lanes), 40)
+        # while both lanes have messages, three urgent ones go for every bulk one
+        self.assertEqual(''.join(lanes[:8]), 'uubu' * 2)
+        self.assertEqual(lanes[:20].count('u'), 15)
+
+    def test_a_lane_alone_gets_everything(self):
+        self.send('ctl.bulk', range(5))
+        lanes = []
+        self.queue('ctl', lanes=[('urgent', 3), ('bulk', 1)]).serve(
+            lambda channel, method, properties, body: lanes.append(method.routing_key))
+        self.assertEqual(lanes, ['ctl.bulk'] * 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
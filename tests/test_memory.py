@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Tests running ASynQ against the in-process broker, so they need no rabbitmq:
+
+    python3 -m unittest discover tests
+"""
+import json
+import unittest
+
+from support import MemoryTestCase
+
+
+class MemoryBrokerTest(MemoryTestCase):
+
+    def test_send_consume_ack_confirm(self):
+        sender = self.queue('asynq_test', sender=True)
+        sender.stream([{'hej': i} for i in range(10)])
+        self.assertEqual(sender._acked, 10)
+        self.assertEqual(sender._outstanding, 0)
+        self.assertEqual(self.broker.queue_length('asynq_test'), 10)
+
+        received = []
+        consumer = self.queue('asynq_test')
+        consumer.serve(lambda channel, method, properties, body: received.append(json.loads(body)['hej']))
+        self.assertEqual(received, list(range(10)))
+        self.assertEqual(self.broker.queue_length('asynq_test'), 0)
+        self.assertEqual(len(consumer._channel.unacked), 0)
+
+    def test_auto_delete_queue_goes_with_its_last_consumer(self):
+        self.queue('otq_test', sender=True, otq=True).client('reply')
+        self.assertEqual(self.broker.queue_length('otq_test'), 1)
+
+        received = []
+        self.queue('otq_test', otq=True).serve(lambda channel, method, properties, body: received.append(body))
+        self.assertEqual(received, [b'reply'])
+        self.assertNotIn('otq_test', self.broker.queues)
+
+
+if __name__ == '__main__':
+    unittest.main()
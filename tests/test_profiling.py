@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import json
+import os
+import pstats
+import unittest
+
+from asynq import profiling
+from support import MemoryTestCase
+
+
+def handle(channel, method, properties, body):
+    pass
+
+
+class ProfilerTest(MemoryTestCase):
+
+    def test_every_nth_invocation_is_profiled_and_dumped(self):
+        dump_dir = self.tempdir()
+        self.send('asynq_test', range(10))
+
+        profiler = profiling.Profiler(dump_dir=dump_dir, every=2, signum=None)
+        consumer = self.queue('asynq_test')
+        consumer.serve(handle, profiler=profiler)
+        self.assertEqual(profiler.invocations, 10)
+        self.assertEqual(profiler.profiled, 5)
+
+        # stopping dumps what was profiled
+        consumer.stop()
+        base = os.path.join(dump_dir, 'asynq-%i' % os.getpid())
+        with open(base + '.phases.json') as f:
+            phases = json.load(f)
+        self.assertEqual(phases['profiled'], 5)
+        self.assertEqual(set(phases['phases']), {'wait', 'ack', 'decode', 'callback'})
+        functions = [function for _, _, function in pstats.Stats(base + '.pstats').stats]
+        self.assertIn('handle', functions)
+
+    def test_signal_opens_a_window(self):
+        profiler = profiling.Profiler(dump_dir=self.tempdir(), signum=None, window=60)
+        profiler.enter()
+        profiler.leave()
+        self.assertEqual(profiler.profiled, 0)
+
+        profiler.on_signal(None, None)
+        profiler.enter()
+        self.assertTrue(profiler.active)
+        profiler.mark('callback')
+        profiler.leave()
+        self.assertEqual(profiler.profiled, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
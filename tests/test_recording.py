@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import os
+import time
+import unittest
+
+import pika
+
+from asynq import recording
+from support import MemoryTestCase
+
+
+class RecordingTest(MemoryTestCase):
+
+    def setUp(self):
+        super(RecordingTest, self).setUp()
+        self.path = os.path.join(self.tempdir(), 'traffic.log')
+
+    def test_record_and_replay(self):
+        self.send('src', ['a', 'b', 'c'])
+        recorder = recording.Recorder(self.path, chunk=1024)
+        self.queue('src').serve(lambda channel, method, properties, body: None, recorder=recorder)
+        recorder.close()
+
+        records = list(recording.read(self.path))
+        self.assertEqual([(key, body) for _, key, _, body in records], [('src', b'a'), ('src', b'b'), ('src', b'c')])
+        self.assertEqual(records[0][2].content_type, 'text/plain')
+
+        recording.Replayer(url='amqp://localhost/', routing_key='dst', transport=self.broker.connect,
+                           speed=0).replay(self.path)
+        self.assertEqual(self.consume('dst'), [b'a', b'b', b'c'])
+
+    def test_reopening_a_log_that_was_never_closed_appends_after_its_records(self):
+        crashed = recording.Recorder(self.path, chunk=4096)
+        crashed.record('k', pika.BasicProperties(), b'before')
+        crashed._map.flush()
+        self.addCleanup(crashed._file.close)
+        self.addCleanup(crashed._map.close)
+
+        recorder = recording.Recorder(self.path, chunk=4096)
+        recorder.record('k', pika.BasicProperties(), b'after')
+        recorder.close()
+        self.assertEqual([body for _, _, _, body in recording.read(self.path)], [b'before', b'after'])
+
+    def test_reopening_something_else_fails(self):
+        for contents in (b'not a log at all', b'short'):
+            with open(self.path, 'wb') as f:
+                f.write(contents)
+            with self.assertRaises(ValueError):
+                recording.Recorder(self.path)
+
+    def test_superseded_messages_are_recorded_when_coalescing(self):
+        self.send('src', [{'v': i} for i in range(6)], headers={'key': 'same'})
+        recorder = recording.Recorder(self.path, chunk=1024)
+        handled = []
+        self.queue('src', coalesce='key').serve(lambda channel, method, properties, body: handled.append(body),
+                                                recorder=recorder)
+        recorder.close()
+        self.assertEqual(len(handled), 1)
+        self.assertEqual(len(list(recording.read(self.path))), 6)
+
+    def test_lane_messages_are_recorded_on_arrival(self):
+        self.send('src.bulk', range(3))
+        recorder = recording.Recorder(self.path, chunk=1024)
+        handled = []
+        self.queue('src', lanes=[('bulk', 1)]).serve(
+            lambda channel, method, properties, body: handled.append(time.time()), recorder=recorder)
+        recorder.close()
+        arrivals = [arrival for arrival, _, _, _ in recording.read(self.path)]
+        self.assertEqual(len(arrivals), 3)
+        # every message was delivered before the first was handled
+        self.assertLessEqual(max(arrivals), min(handled))
+
+
+if __name__ == '__main__':
+    unittest.main()
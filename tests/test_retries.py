@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import unittest
+
+from asynq import dedup
+from support import MemoryTestCase
+
+
+class RetryTest(MemoryTestCase):
+
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        self.attempts = []
+
+    def fail(self, channel, method, properties, body):
+        self.attempts.append((method.routing_key, (properties.headers or {}).get('x-retry-count')))
+        raise RuntimeError('poison')
+
+    def test_failing_callback_is_retried_and_dead_lettered(self):
+        self.send('asynq_test', ['poison'])
+        consumer = self.queue('asynq_test', retries=2, retry_delay=0.01)
+        consumer.serve(self.fail)
+        self.assertEqual([count for _, count in self.attempts], [None, 1, 2])
+        self.assertEqual((consumer.retried, consumer.dead), (2, 1))
+        self.assertEqual(self.consume('asynq_test.dead'), [b'poison'])
+
+    def test_retries_are_not_taken_for_duplicates(self):
+        self.send('asynq_test', ['poison'])
+        self.queue('asynq_test', retries=2, retry_delay=0.01).serve(self.fail, dedup=dedup.DedupCache())
+        self.assertEqual([count for _, count in self.attempts], [None, 1, 2])
+        self.assertEqual(self.broker.queue_length('asynq_test.dead'), 1)
+
+    def test_lane_messages_are_retried_on_their_lane(self):
+        self.send('ln.bulk', ['poison'])
+        self.queue('ln', lanes=[('urgent', 3), ('bulk', 1)], retries=2, retry_delay=0.01).serve(self.fail)
+        self.assertEqual(self.attempts, [('ln.bulk', None), ('ln.bulk', 1), ('ln.bulk', 2)])
+        self.assertEqual(self.broker.queue_length('ln.dead'), 1)
+
+    def test_messages_which_succeed_are_not_retried(self):
+        self.send('asynq_test', ['fine'])
+        consumer = self.queue('asynq_test', retries=2, retry_delay=0.01)
+        consumer.serve(lambda channel, method, properties, body: None)
+        self.assertEqual((consumer.retried, consumer.dead), (0, 0))
+        self.assertEqual(self.broker.queue_length('asynq_test.retry.0'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
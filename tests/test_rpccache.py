@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import json
+import time
+import unittest
+import uuid
+
+from asynq import rpccache
+from support import URL, MemoryTestCase
+
+
+class ResponseCacheTest(MemoryTestCase):
+
+    def cache(self, handler, workers):
+        cache = rpccache.ResponseCache(handler, rpccache.otq_reply(URL, transport=self.broker.connect),
+                                       key=lambda body: json.loads(body)['hej'],
+                                       reply_to=lambda properties, body: json.loads(body)['uuid'], workers=workers)
+        self.addCleanup(cache.close)
+        return cache
+
+    def request(self, hej):
+        my_uuid = str(uuid.uuid4())
+        self.queue('norm_queue', sender=True).client({'hej': hej, 'uuid': my_uuid})
+        return my_uuid
+
+    def replies(self, my_uuid):
+        return [json.loads(body) for body in self.consume(my_uuid, otq=True)]
+
+    def test_identical_requests_are_answered_once(self):
+        for workers in (0, 2):
+            with self.subTest(workers=workers):
+                # a fresh broker, so the consumer of the last round is not around
+                self.setUp()
+                calls = []
+
+                def handler(body):
+                    calls.append(body)
+                    # slow enough for the consumer to run out of deliveries before the worker is done
+                    time.sleep(0.05)
+                    return {'answer': json.loads(body)['hej']}
+
+                cache = self.cache(handler, workers)
+                uuids = [self.request(i % 2) for i in range(4)]
+                self.queue('norm_queue').serve(cache.callback)
+
+                self.assertEqual(len(calls), 2)
+                self.assertEqual(cache.hits + cache.collapsed, 2)
+                for i, my_uuid in enumerate(uuids):
+                    self.assertEqual(self.replies(my_uuid), [{'answer': i % 2}])
+
+    def test_failing_requests_are_retried_and_dead_lettered(self):
+        def handler(body):
+            raise RuntimeError('down')
+
+        for workers in (0, 2):
+            with self.subTest(workers=workers):
+                self.setUp()
+                cache = self.cache(handler, workers)
+                uuids = [self.request(1) for _ in range(2)]
+                self.queue('norm_queue', retries=1, retry_delay=0.01).serve(cache.callback)
+
+                self.assertEqual(cache.stats()['failures'], 4)
+                self.assertEqual(self.broker.queue_length('norm_queue.dead'), 2)
+                for my_uuid in uuids:
+                    self.assertEqual(self.replies(my_uuid), [])
+
+    def test_failing_requests_without_retries_raise(self):
+        def handler(body):
+            raise RuntimeError('down')
+
+        for workers in (0, 2):
+            with self.subTest(workers=workers):
+                self.setUp()
+                cache = self.cache(handler, workers)
+                self.request(1)
+                with self.assertRaises(RuntimeError):
+                    self.queue('norm_queue').serve(cache.callback)
+
+
+if __name__ == '__main__':
+    unittest.main()
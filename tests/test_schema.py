@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import json
+import unittest
+
+from asynq import schema
+from support import MemoryTestCase
+
+REQUEST = schema.Schema('Request', [('hej', str), ('uuid', str), ('n', float, 0.0)])
+
+
+class SchemaTest(unittest.TestCase):
+
+    def test_decode(self):
+        record = REQUEST.decode(b'{"hej": "3", "uuid": "u", "n": 2}')
+        self.assertEqual((record.hej, record.uuid, record.n), ('3', 'u', 2))
+        self.assertEqual(REQUEST.decode(b'{"hej": "3", "uuid": "u"}').n, 0.0)
+
+    def test_mismatches(self):
+        for body in (b'[]', b'{"uuid": "u"}', b'{"hej": 3, "uuid": "u"}', b'{"hej": "3", "uuid": "u", "n": true}',
+                     b'not json'):
+            with self.subTest(body=body):
+                with self.assertRaises(schema.SchemaError):
+                    REQUEST.decode(body)
+
+    def test_names_are_not_code(self):
+        # keywords are fine as json keys, and names only ever end up in error messages
+        keywords = schema.Schema('Bad"); raise SystemExit #', [('class', str), ('from', int, None)])
+        record = keywords.decode(b'{"class": "a"}')
+        self.assertEqual((getattr(record, 'class'), getattr(record, 'from')), ('a', None))
+        with self.assertRaisesRegex(schema.SchemaError, 'missing field class'):
+            keywords.decode(b'{}')
+
+    def test_field_names_must_be_identifiers(self):
+        with self.assertRaises(ValueError):
+            schema.Schema('Bad', [('content-type', str)])
+
+    def test_columns(self):
+        nullable = schema.Schema('Sample', [('name', str), ('count', int, None), ('weight', float)])
+        columns = nullable.columns([b'{"name": "a", "weight": 1}', b'{"name": "b", "count": 2, "weight": 0.5}'])
+        self.assertEqual(columns['name'], ['a', 'b'])
+        self.assertEqual(list(columns['count']), [None, 2])
+        self.assertEqual(columns['weight'].typecode, 'd')
+        self.assertEqual(list(columns['weight']), [1.0, 0.5])
+
+
+class SchemaConsumerTest(MemoryTestCase):
+
+    def test_callback_gets_records(self):
+        self.send('norm_queue', [{'hej': '3', 'uuid': 'u'}])
+        received = []
+        self.queue('norm_queue', schemas={'norm_queue': REQUEST}).serve(
+            lambda channel, method, properties, body: received.append(body))
+        self.assertEqual(received, [REQUEST.decode(b'{"hej": "3", "uuid": "u"}')])
+
+    def test_bodies_which_do_not_decode_are_dead_lettered(self):
+        self.send('norm_queue', [{'hej': 3, 'uuid': 'u'}])
+        received = []
+        consumer = self.queue('norm_queue', schemas={'norm_queue': REQUEST}, retries=2)
+        consumer.serve(lambda channel, method, properties, body: received.append(body))
+        self.assertEqual(received, [])
+        self.assertEqual(consumer.retried, 0)
+        self.assertEqual(consumer.dead, 1)
+        self.assertEqual([json.loads(body) for body in self.consume('norm_queue.dead')], [{'hej': 3, 'uuid': 'u'}])
+
+
+if __name__ == '__main__':
+    unittest.main()